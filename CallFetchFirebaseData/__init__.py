@@ -1,14 +1,14 @@
 # CallFetchFirebaseData/__init__.py
 import logging
-import requests
 import os
+from shared_code.http_client import client
 
-def main(name: str) -> str:
+async def main(name: str) -> str:
     logging.info("Calling FetchFirebaseData HTTP function...")
 
     try:
         fetch_url = os.environ["FETCH_FIREBASE_URL"]  # Set this in Azure Function App Settings
-        response = requests.post(fetch_url)
+        response = await client.post(fetch_url, headers={"Accept-Encoding": "gzip"})
         response.raise_for_status()
         logging.info(f"FetchFirebaseData response: {response.text}")
         return response.text
@@ -1,19 +1,30 @@
 # CallTriggerPrediction/__init__.py
 import logging
-import requests
 import os
-import json
+import orjson
+from shared_code.http_client import client
 
-def main(input_data: str) -> str:
+async def main(input_data: str) -> str:
     logging.info("Calling TriggerPrediction HTTP function...")
 
     try:
         trigger_url = os.environ["TRIGGER_PREDICTION_URL"]
 
-        # Ensure input_data is parsed as JSON
-        json_data = json.loads(input_data)
+        # Parsed only to check for an empty window; input_data is already the
+        # JSON text FetchFirebaseData returned, so it is forwarded as is
+        json_data = orjson.loads(input_data)
 
-        response = requests.post(trigger_url, json=json_data)
+        # Nothing stored in FetchFirebaseData's window yet (a fresh database
+        # on a quiet tick); there is no history to forecast from
+        if isinstance(json_data, dict) and not any(json_data.values()):
+            logging.info("No sensor readings to forecast from; skipping TriggerPrediction.")
+            return "Skipped: no sensor readings"
+
+        response = await client.post(
+            trigger_url,
+            content=input_data,
+            headers={"Content-Type": "application/json"},
+        )
         response.raise_for_status()
 
         logging.info(f"TriggerPrediction response: {response.text}")
@@ -1,40 +1,99 @@
 import azure.functions as func
 import os
 import logging
+import asyncio
 import json
-from azure.storage.blob import BlobServiceClient
+import gzip
+import orjson
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from azure.storage.blob.aio import BlobServiceClient
 import psycopg2
+import psycopg2.pool
+from psycopg2.extras import execute_values
 from urllib.parse import urlparse, unquote
-from datetime import datetime
+import pandas as pd
 
 # Firebase Admin SDK
 import firebase_admin
 from firebase_admin import credentials, db
 
-def download_credentials():
+# (column, type, default) for every sensor reading field, in table order.
+# Casting and defaults are applied per column from this one table.
+SENSOR_SCHEMA = (
+    ("temperature", float, 0.0),
+    ("humidity", float, 0.0),
+    ("occupancy", int, 0),
+    ("energy", float, 0.0),
+    ("current", float, 0.0),
+    ("voltage", float, 0.0),
+    ("power_factor", float, 1.0),
+    ("power", float, 0.0),
+)
+
+SENSOR_COLUMNS = [key for key, _, _ in SENSOR_SCHEMA]
+SENSOR_DEFAULTS = {key: default for key, _, default in SENSOR_SCHEMA}
+SENSOR_DTYPES = {"building_id": int, **{key: cast for key, cast, _ in SENSOR_SCHEMA}}
+
+def env_int(name, default, minimum=0):
+    # A malformed setting must not fail the import, where the host only
+    # reports an opaque load error; warn and keep the default instead.
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    try:
+        parsed = int(value)
+    except ValueError:
+        parsed = None
+    if parsed is None or parsed < minimum:
+        logging.warning(f"Invalid {name}={value!r}; using {default}")
+        return default
+    return parsed
+
+# Parallel COPY workers (and pooled connections) used to load a snapshot
+INGEST_WORKERS = 4
+
+# Rows per COPY statement; hypertables keep scaling up to ~20k rows per batch
+COPY_BATCH_SIZE = env_int("SENSOR_COPY_BATCH_SIZE", 20000, minimum=1)
+
+# Readings keyed up to this far behind a building's cursor are re-read
+# each run, so one that reaches Firebase late (with a key below the
+# cursor) is still ingested. Anything later than this is not picked up.
+INGEST_OVERLAP = pd.Timedelta(minutes=env_int("INGEST_OVERLAP_MINUTES", 60))
+
+# Hours of stored history, counted back from the newest reading, that
+# are handed on to TriggerPrediction as the forecast input
+PREDICTION_WINDOW_HOURS = env_int("PREDICTION_WINDOW_HOURS", 744, minimum=1)
+
+# Module state survives across warm invocations of the same worker
+_pg_pool = None
+_pg_pool_lock = threading.Lock()
+_schema_initialized = False
+
+async def download_credentials():
     try:
         logging.info("Attempting to download firebase_credentials.json from Azure Blob...")
 
-        blob_service_client = BlobServiceClient.from_connection_string(os.environ['BLOB_CONNECTION_STRING'])
-        blob_client = blob_service_client.get_blob_client(container="credentials", blob="firebase_credentials.json")
+        async with BlobServiceClient.from_connection_string(os.environ['BLOB_CONNECTION_STRING']) as blob_service_client:
+            blob_client = blob_service_client.get_blob_client(container="credentials", blob="firebase_credentials.json")
 
-        download_path = "/tmp/firebase_credentials.json"
-        with open(download_path, "wb") as f:
-            blob_data = blob_client.download_blob().readall()
-            f.write(blob_data)
+            # Parse straight from memory; no /tmp round-trip for firebase_admin to re-read
+            stream = await blob_client.download_blob()
+            cred_info = json.loads(await stream.readall())
 
         logging.info("Firebase credentials successfully downloaded.")
-        return download_path
+        return cred_info
     except Exception as e:
         logging.error(f"Failed to download Firebase credentials: {e}", exc_info=True)
         raise
 
-def initialize_firebase(credential_path: str):
+def initialize_firebase(cred_info):
     try:
         logging.info("Initializing Firebase Admin SDK...")
 
         if not firebase_admin._apps:
-            cred = credentials.Certificate(credential_path)
+            cred = credentials.Certificate(cred_info)
             firebase_admin.initialize_app(cred, {
                 "databaseURL": os.environ.get("FIREBASE_DB_URL")
             })
@@ -48,96 +107,181 @@ def initialize_firebase(credential_path: str):
         logging.error(f"Firebase initialization error: {e}", exc_info=True)
         raise
 
+def fetch_new_readings(ref, cursors):
+    # A shallow read lists building keys without downloading their readings
+    building_ids = ref.get(shallow=True)
+    if not building_ids:
+        return {}
+
+    def fetch_building(building_id):
+        query = ref.child(str(building_id)).order_by_key()
+        # Cursors are kept per stored building_id, so "01" and "1" share one
+        last_key = cursors.get(int(building_id)) if str(building_id).isdigit() else None
+        if last_key is None:
+            return query.get()
+        # Re-reading the overlap re-upserts a few stored readings, which is
+        # harmless, and catches late arrivals keyed behind the cursor
+        return query.start_at(overlap_start_key(last_key)).get()
+
+    with ThreadPoolExecutor(max_workers=INGEST_WORKERS) as executor:
+        fetched = executor.map(fetch_building, building_ids)
+        return {
+            building_id: readings
+            for building_id, readings in zip(building_ids, fetched)
+            if isinstance(readings, dict) and readings
+        }
+
+def overlap_start_key(last_key):
+    # Keys are ISO timestamps, so key order is time order. The start key
+    # keeps the cursor's date/time separator and drops its fraction and
+    # offset, which only makes it sort at or before every key of that second.
+    start = pd.to_datetime(last_key, utc=True, errors="coerce")
+    if pd.isna(start):
+        return last_key
+    separator = last_key[10] if len(last_key) > 10 else "T"
+    return (start - INGEST_OVERLAP).strftime(f"%Y-%m-%d{separator}%H:%M:%S")
+
 def parse_database_url(db_url):
     parsed = urlparse(db_url)
     return {
         "dbname": parsed.path.lstrip("/"),
         "user": parsed.username,
-        "password": unquote(parsed.password),
+        "password": unquote(parsed.password) if parsed.password is not None else None,
         "host": parsed.hostname,
         "port": parsed.port,
         "sslmode": "require"
     }
 
-def store_sensor_data(snapshot, db_url):
+# Parsed once per worker rather than on every invocation. A bad setting
+# must not fail the import, where the host only reports an opaque load
+# error; main turns a None here into a 500 with a message instead.
+try:
+    _PG_KWARGS = parse_database_url(os.environ["TIMESCALEDB_CONNECTION"]) if os.environ.get("TIMESCALEDB_CONNECTION") else None
+except Exception as e:
+    logging.error(f"Invalid TIMESCALEDB_CONNECTION: {e}")
+    _PG_KWARGS = None
+
+def get_pg_pool():
+    global _pg_pool
+    if _pg_pool is None:
+        with _pg_pool_lock:
+            if _pg_pool is None:
+                # One connection per ingest worker is kept open between runs.
+                # getconn raises rather than waits when the pool is exhausted,
+                # so a second invocation overlapping on this worker (a manual
+                # call during a timer run) gets its own set on top of those.
+                # TCP keepalives stop idle pooled sockets being dropped between timer runs
+                _pg_pool = psycopg2.pool.ThreadedConnectionPool(
+                    INGEST_WORKERS, 2 * INGEST_WORKERS, keepalives=1, keepalives_idle=60, **_PG_KWARGS
+                )
+    return _pg_pool
+
+def ensure_sensor_schema(pool):
+    global _schema_initialized
+    # Ensure sensor_data table exists; once per warm worker is enough
+    if _schema_initialized:
+        return
+
+    conn = pool.getconn()
     try:
-        conn = psycopg2.connect(**parse_database_url(db_url))
-        cur = conn.cursor()
-
-        # Ensure sensor_data table exists
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS sensor_data (
-                timestamp TIMESTAMP NOT NULL,
-                building_id INT NOT NULL,
-                temperature DOUBLE PRECISION,
-                humidity DOUBLE PRECISION,
-                occupancy INT,
-                energy DOUBLE PRECISION,
-                current DOUBLE PRECISION,
-                voltage DOUBLE PRECISION,
-                power_factor DOUBLE PRECISION,
-                power DOUBLE PRECISION,
-                PRIMARY KEY (timestamp, building_id)
-            );
-        """)
-
-        rows = []
-        flattened = {
-            "temperature": [],
-            "humidity": [],
-            "occupancy": [],
-            "energy": [],
-            "current": [],
-            "voltage": [],
-            "power_factor": [],
-            "power": []
-        }
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS sensor_data (
+                    timestamp TIMESTAMP NOT NULL,
+                    building_id INT NOT NULL,
+                    temperature DOUBLE PRECISION,
+                    humidity DOUBLE PRECISION,
+                    occupancy INT,
+                    energy DOUBLE PRECISION,
+                    current DOUBLE PRECISION,
+                    voltage DOUBLE PRECISION,
+                    power_factor DOUBLE PRECISION,
+                    power DOUBLE PRECISION,
+                    source TEXT NOT NULL DEFAULT 'firebase',
+                    PRIMARY KEY (timestamp, building_id)
+                );
+                -- TriggerPrediction also writes rows here; source tells them
+                -- apart from ingested readings. Tables created before the
+                -- column existed get it here.
+                ALTER TABLE sensor_data ADD COLUMN IF NOT EXISTS source TEXT NOT NULL DEFAULT 'firebase';
+                CREATE TABLE IF NOT EXISTS ingest_cursor (
+                    building_id INT PRIMARY KEY,
+                    last_key TEXT NOT NULL
+                );
+            """)
+        conn.commit()
+        _schema_initialized = True
+    finally:
+        pool.putconn(conn)
 
-        # Accept both list- and dict-based Firebase formats
-        if isinstance(snapshot, dict):
-            iterable = snapshot.items()
-        elif isinstance(snapshot, list):
-            iterable = enumerate(snapshot)
-        else:
-            logging.warning("Unsupported Firebase snapshot type.")
-            return flattened
-
-        for building_id, readings in iterable:
-            if not isinstance(readings, dict):
-                continue
-            for ts_str, values in readings.items():
-                try:
-                    ts = datetime.fromisoformat(ts_str.replace("Z", "+00:00"))
-                    temp = float(values.get("temperature", 0))
-                    hum = float(values.get("humidity", 0))
-                    occ = int(values.get("occupancy", 0))
-                    energy = float(values.get("energy", 0))
-                    current = float(values.get("current", 0))
-                    voltage = float(values.get("voltage", 0))
-                    pf = float(values.get("power_factor", 1))
-                    power = float(values.get("power", 0))
-
-                    rows.append((ts, int(building_id), temp, hum, occ, energy, current, voltage, pf, power))
-
-                    # Populate flattened
-                    flattened["temperature"].append(temp)
-                    flattened["humidity"].append(hum)
-                    flattened["occupancy"].append(occ)
-                    flattened["energy"].append(energy)
-                    flattened["current"].append(current)
-                    flattened["voltage"].append(voltage)
-                    flattened["power_factor"].append(pf)
-                    flattened["power"].append(power)
-
-                except Exception as e:
-                    logging.warning(f"Invalid row (building_id={building_id}, timestamp={ts_str}): {e}")
-
-        if rows:
-            cur.executemany("""
-                INSERT INTO sensor_data (
-                    timestamp, building_id, temperature, humidity, occupancy,
-                    energy, current, voltage, power_factor, power
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+def load_ingest_cursors(pool):
+    # Highest Firebase reading key already ingested, per building
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT building_id, last_key FROM ingest_cursor")
+            cursors = dict(cur.fetchall())
+        conn.commit()
+        return cursors
+    finally:
+        pool.putconn(conn)
+
+def latest_reading_keys(snapshot):
+    # Only timestamp keys may advance a cursor; a stray non-timestamp node
+    # would otherwise sort past every later reading and hide it for good.
+    # Building keys that store as one building_id ("01" and "1") fold into
+    # one cursor, since an upsert rejects a key repeated within it.
+    cursors = {}
+    for building_id, readings in snapshot.items():
+        keys = pd.Series(list(readings), dtype=object)
+        keys = keys[pd.to_datetime(keys, utc=True, errors="coerce").notna()]
+        if str(building_id).isdigit() and not keys.empty:
+            building_id = int(building_id)
+            cursors[building_id] = max(keys.max(), cursors.get(building_id, ""))
+    return cursors
+
+def save_ingest_cursors(pool, cursors):
+    if not cursors:
+        return
+
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            execute_values(cur, """
+                INSERT INTO ingest_cursor (building_id, last_key) VALUES %s
+                ON CONFLICT (building_id) DO UPDATE
+                SET last_key = GREATEST(ingest_cursor.last_key, EXCLUDED.last_key)
+            """, list(cursors.items()))
+        conn.commit()
+    finally:
+        pool.putconn(conn)
+
+def copy_sensor_rows(pool, df):
+    # Each shard loads on its own pooled connection and transaction
+    conn = pool.getconn()
+    try:
+        # psycopg2 would send BEGIN and COMMIT as round-trips of their own;
+        # issuing them explicitly lets each ride along with a real statement.
+        conn.autocommit = True
+        # COPY into a transaction-scoped staging table, then merge with a
+        # single upsert so ON CONFLICT semantics are preserved.
+        # source is left to its 'firebase' default
+        copy_columns = ", ".join(df.columns)
+        with conn.cursor() as cur:
+            cur.execute("""
+                BEGIN;
+                CREATE TEMP TABLE sensor_stage (LIKE sensor_data INCLUDING DEFAULTS) ON COMMIT DROP;
+            """)
+            for start in range(0, len(df), COPY_BATCH_SIZE):
+                # pandas renders the datetime64 column in one pass; no per-row
+                # Python datetime objects are built on the way to Postgres.
+                buf = io.StringIO()
+                df.iloc[start:start + COPY_BATCH_SIZE].to_csv(buf, header=False, index=False, date_format="%Y-%m-%d %H:%M:%S.%f")
+                buf.seek(0)
+                cur.copy_expert(f"COPY sensor_stage ({copy_columns}) FROM STDIN WITH CSV", buf)
+            cur.execute("""
+                INSERT INTO sensor_data
+                SELECT * FROM sensor_stage
                 ON CONFLICT (timestamp, building_id) DO UPDATE
                 SET temperature = EXCLUDED.temperature,
                     humidity = EXCLUDED.humidity,
@@ -146,46 +290,161 @@ def store_sensor_data(snapshot, db_url):
                     current = EXCLUDED.current,
                     voltage = EXCLUDED.voltage,
                     power_factor = EXCLUDED.power_factor,
-                    power = EXCLUDED.power
-            """, rows)
-            logging.info(f"{len(rows)} sensor rows inserted/updated.")
-        else:
-            logging.info("No valid sensor data rows found in snapshot.")
+                    power = EXCLUDED.power,
+                    source = EXCLUDED.source;
+                COMMIT;
+            """)
+    finally:
+        # conn.rollback() is a no-op under autocommit, so a failed shard's
+        # transaction has to be closed by hand before the pool reuses it.
+        # If the socket has died this cleanup fails too; the connection is
+        # then discarded rather than returned, and the original error stands.
+        broken = False
+        try:
+            if not conn.closed:
+                if conn.info.transaction_status in (
+                    psycopg2.extensions.TRANSACTION_STATUS_INTRANS, psycopg2.extensions.TRANSACTION_STATUS_INERROR
+                ):
+                    with conn.cursor() as cur:
+                        cur.execute("ROLLBACK")
+                conn.autocommit = False
+        except psycopg2.Error:
+            broken = True
+        pool.putconn(conn, close=broken or bool(conn.closed))
 
+def load_prediction_window(pool):
+    # The forecast input is the stored history, not just this run's new
+    # readings: the last PREDICTION_WINDOW_HOURS before the newest reading,
+    # flattened column-wise in time order. Only ingested readings count;
+    # the rows TriggerPrediction writes back would otherwise feed each
+    # forecast into the next one.
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT {", ".join(SENSOR_COLUMNS)}
+                FROM sensor_data
+                WHERE source = 'firebase'
+                  AND timestamp >= (
+                      SELECT MAX(timestamp) FROM sensor_data WHERE source = 'firebase'
+                  ) - %s * INTERVAL '1 hour'
+                ORDER BY timestamp, building_id
+            """, (PREDICTION_WINDOW_HOURS,))
+            rows = cur.fetchall()
         conn.commit()
-        cur.close()
-        conn.close()
+    finally:
+        pool.putconn(conn)
+
+    columns = list(zip(*rows)) or [()] * len(SENSOR_COLUMNS)
+    return {key: list(values) for key, values in zip(SENSOR_COLUMNS, columns)}
+
+def store_sensor_data(snapshot):
+    try:
+        pool = get_pg_pool()
+        ensure_sensor_schema(pool)
 
-        return flattened
+        # Accept both list- and dict-based Firebase formats
+        if isinstance(snapshot, dict):
+            iterable = snapshot.items()
+        elif isinstance(snapshot, list):
+            iterable = enumerate(snapshot)
+        else:
+            logging.warning("Unsupported Firebase snapshot type.")
+            return 0
+
+        records = [
+            {**values, "building_id": building_id, "timestamp": ts_str}
+            for building_id, readings in iterable if isinstance(readings, dict)
+            for ts_str, values in readings.items() if isinstance(values, dict)
+        ]
+
+        df = pd.DataFrame()
+        if records:
+            df = pd.DataFrame.from_records(records, columns=["timestamp", "building_id", *SENSOR_COLUMNS])
+
+            # Cast whole columns at once; a value that is present but unparseable invalidates its row
+            timestamps = pd.to_datetime(df["timestamp"], utc=True, errors="coerce")
+            numeric = df[["building_id", *SENSOR_COLUMNS]].apply(pd.to_numeric, errors="coerce")
+            invalid = timestamps.isna() | numeric["building_id"].isna() | (numeric.isna() & df[numeric.columns].notna()).any(axis=1)
+            if invalid.any():
+                logging.warning(f"Skipping {int(invalid.sum())} invalid sensor readings.")
+
+            df = numeric[~invalid].fillna(SENSOR_DEFAULTS).astype(SENSOR_DTYPES)
+            df.insert(0, "timestamp", timestamps[~invalid].dt.tz_localize(None))
+
+            # Distinct Firebase keys can land on one primary key ("...Z" and
+            # "...+00:00", building "01" and "1"); a single upsert rejects a
+            # key repeated within it, so keep the last reading per key.
+            df = df.drop_duplicates(["timestamp", "building_id"], keep="last")
+
+            # Time-ordered rows keep inserts on the active hypertable chunk.
+            df = df.sort_values(["timestamp", "building_id"], kind="stable")
+
+        if not df.empty:
+            # Shards never share a building_id, so they never touch the same
+            # primary key and can load in parallel, each in its own COPY.
+            shards = [shard for _, shard in df.groupby(df["building_id"] % INGEST_WORKERS, sort=False)]
+            with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+                list(executor.map(lambda shard: copy_sensor_rows(pool, shard), shards))
+            logging.info(f"{len(df)} sensor rows inserted/updated across {len(shards)} shard(s).")
+        else:
+            logging.info("No valid sensor data rows found in snapshot.")
+
+        return len(df)
 
     except Exception as e:
         logging.error(f"Database error: {e}", exc_info=True)
         raise
 
-def main(req: func.HttpRequest) -> func.HttpResponse:
+async def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info("FetchFirebaseData function triggered.")
 
     try:
-        cred_path = download_credentials()
-        db_url = os.environ['TIMESCALEDB_CONNECTION']
-        if not db_url:
-            raise ValueError("Missing TIMESCALEDB_CONNECTION in environment variables")
+        if _PG_KWARGS is None:
+            raise ValueError("Missing or invalid TIMESCALEDB_CONNECTION in environment variables")
+
+        # On a cold worker the Blob download and the Postgres pool's connects
+        # are independent, so overlap them. Credentials are only needed until
+        # the Firebase app is initialized; asyncio.sleep(0) stands in for them after that.
+        cred_info, pool = await asyncio.gather(
+            download_credentials() if not firebase_admin._apps else asyncio.sleep(0),
+            asyncio.to_thread(get_pg_pool),
+        )
 
-        ref = initialize_firebase(cred_path)
+        ref = initialize_firebase(cred_info)
         logging.info("Firebase connection established.")
 
-        snapshot = ref.get()
-        if not snapshot:
-            logging.warning("No data found in Firebase.")
-            return func.HttpResponse("No sensor data found in Firebase.", status_code=204)
+        # Blocking SDK and driver calls run off the event loop.
+        # Only readings from each building's ingest cursor (less the
+        # overlap) onward are fetched, so ingest costs O(new readings)
+        # rather than O(history).
+        await asyncio.to_thread(ensure_sensor_schema, pool)
+        cursors = await asyncio.to_thread(load_ingest_cursors, pool)
+        snapshot = await asyncio.to_thread(fetch_new_readings, ref, cursors)
+        if snapshot:
+            logging.info("Sensor data snapshot fetched.")
+            await asyncio.to_thread(store_sensor_data, snapshot)
+
+            # Advance the cursors only once the readings are stored
+            await asyncio.to_thread(save_ingest_cursors, pool, latest_reading_keys(snapshot))
+        else:
+            # A quiet tick still forecasts from the stored history
+            logging.info("No new data found in Firebase.")
+
+        flattened = await asyncio.to_thread(load_prediction_window, pool)
 
-        logging.info("Sensor data snapshot fetched.")
-        flattened = store_sensor_data(snapshot, db_url)
+        # Float-list JSON compresses well; level 1 keeps the CPU cost near a memcpy
+        body = orjson.dumps(flattened)
+        headers = {}
+        if "gzip" in req.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body, compresslevel=1)
+            headers["Content-Encoding"] = "gzip"
 
         return func.HttpResponse(
-            json.dumps(flattened),
+            body,
             status_code=200,
-            mimetype="application/json"
+            mimetype="application/json",
+            headers=headers
         )
 
     except Exception as e:
@@ -1,19 +1,74 @@
 # OptimizeEnergy/optimize_energy.py
+import threading
 import psycopg2
+import psycopg2.pool
 import json
 from datetime import datetime
 
+# Ordered by precedence: the first matching rule wins
+RECOMMENDATIONS = (
+    {
+        "description": "Optimize power factor: Consider adding power factor correction capacitors.",
+        "priority": "high",
+        "tag": "power_factor"
+    },
+    {
+        "description": "Reduce energy usage: Schedule high-energy equipment during off-peak hours.",
+        "priority": "medium",
+        "tag": "energy_spike"
+    },
+    {
+        "description": "Reduce HVAC and lighting: Low occupancy detected with high usage.",
+        "priority": "medium",
+        "tag": "occupancy_mismatch"
+    },
+    {
+        "description": "Adjust HVAC: Temperature exceeds 26°C, consider cooling optimization.",
+        "priority": "low",
+        "tag": "temperature_control"
+    },
+    {
+        "description": "No immediate action required: Conditions within optimal range.",
+        "priority": "low",
+        "tag": "normal"
+    },
+)
+
+# Serialized once at import and bound as jsonb parameters
+RECOMMENDATION_JSON = [json.dumps(recommendation) for recommendation in RECOMMENDATIONS]
+
+# Pooled Postgres connections reused across warm invocations
+_pg_pool = None
+_pg_pool_lock = threading.Lock()
+_schema_initialized = False
+
+def get_pg_pool(db_connection):
+    global _pg_pool
+    if _pg_pool is None:
+        with _pg_pool_lock:
+            if _pg_pool is None:
+                _pg_pool = psycopg2.pool.ThreadedConnectionPool(
+                    1, 8, db_connection, keepalives=1, keepalives_idle=60
+                )
+    return _pg_pool
+
 def generate_recommendations_from_db(db_connection):
     """
     Generate energy optimization recommendations based on sensor data and predictions.
     Stores recommendations in the recommendations table.
     """
+    global _schema_initialized
+    pool = get_pg_pool(db_connection)
+    conn = pool.getconn()
+    # A multi-statement string already runs as one implicit transaction, so
+    # autocommit saves the separate BEGIN and COMMIT round-trips psycopg2 would add
+    conn.autocommit = True
     try:
-        conn = psycopg2.connect(db_connection)
         cur = conn.cursor()
 
-        # Ensure the recommendations table exists
-        cur.execute("""
+        # Ensure the recommendations table exists; once per warm worker is enough,
+        # and on a cold worker it rides in the same round-trip as the upsert
+        schema_sql = "" if _schema_initialized else """
             CREATE TABLE IF NOT EXISTS recommendations (
                 timestamp TIMESTAMP NOT NULL,
                 building_id INT NOT NULL,
@@ -21,87 +76,59 @@ def generate_recommendations_from_db(db_connection):
                 recommendation JSONB,
                 PRIMARY KEY (timestamp, building_id)
             );
-        """)
+        """
 
-        # Fetch recent sensor and prediction data
-        cur.execute("""
-            SELECT 
-                s.timestamp, 
-                s.building_id, 
-                s.energy, 
-                s.occupancy, 
-                s.power_factor, 
-                s.temperature, 
-                p.predicted_energy, 
-                p.anomaly
+        # Classify the last 24 hours and upsert the result in one statement;
+        # the CASE branches follow RECOMMENDATIONS' precedence order and no
+        # sensor rows cross the wire. NULL readings fail every test and fall
+        # through to the last entry.
+        power_factor, energy_spike, occupancy_mismatch, temperature_control, normal = RECOMMENDATION_JSON
+        # Recommendations are derived data a rerun regenerates, so this
+        # transaction need not wait for its WAL flush; SET LOCAL ends with it
+        cur.execute("SET LOCAL synchronous_commit TO OFF;" + schema_sql + """
+            INSERT INTO recommendations (timestamp, building_id, predicted_energy, recommendation)
+            SELECT
+                s.timestamp,
+                s.building_id,
+                COALESCE(p.predicted_energy, 0.0),
+                CASE
+                    WHEN starts_with(p.anomaly, 'power_factor_abnormal:') THEN %(power_factor)s::jsonb
+                    WHEN p.predicted_energy <> 0 AND s.energy > p.predicted_energy * 1.2 THEN %(energy_spike)s::jsonb
+                    WHEN s.occupancy < 5 AND s.energy > 30 THEN %(occupancy_mismatch)s::jsonb
+                    WHEN s.temperature > 26 THEN %(temperature_control)s::jsonb
+                    ELSE %(normal)s::jsonb
+                END
             FROM sensor_data s
-            LEFT JOIN predictions p 
-                ON s.timestamp = p.timestamp 
+            LEFT JOIN predictions p
+                ON s.timestamp = p.timestamp
                 AND s.building_id = p.building_id
+                -- Postgres doesn't carry the WHERE window across an outer join;
+                -- repeating it lets predictions be range-scanned on its primary key
+                AND p.timestamp >= NOW() - INTERVAL '24 hours'
             WHERE s.timestamp >= NOW() - INTERVAL '24 hours'
-            ORDER BY s.timestamp, s.building_id;
-        """)
-        rows = cur.fetchall()
-
-        recommendations = []
+            -- Time-ordered rows keep inserts on the active hypertable chunk
+            ORDER BY s.timestamp, s.building_id
+            ON CONFLICT (timestamp, building_id) DO UPDATE
+              SET predicted_energy = EXCLUDED.predicted_energy,
+                  recommendation = EXCLUDED.recommendation
+        """, {
+            "power_factor": power_factor,
+            "energy_spike": energy_spike,
+            "occupancy_mismatch": occupancy_mismatch,
+            "temperature_control": temperature_control,
+            "normal": normal,
+        })
+        recommendation_count = cur.rowcount
 
-        for row in rows:
-            timestamp, building_id, energy, occupancy, power_factor, temperature, predicted_energy, anomaly = row
-            recommendation = {}
-
-            if anomaly and "power_factor_abnormal" in anomaly:
-                recommendation = {
-                    "description": "Optimize power factor: Consider adding power factor correction capacitors.",
-                    "priority": "high",
-                    "tag": "power_factor"
-                }
-            elif predicted_energy and energy > predicted_energy * 1.2:
-                recommendation = {
-                    "description": "Reduce energy usage: Schedule high-energy equipment during off-peak hours.",
-                    "priority": "medium",
-                    "tag": "energy_spike"
-                }
-            elif occupancy < 5 and energy > 30:
-                recommendation = {
-                    "description": "Reduce HVAC and lighting: Low occupancy detected with high usage.",
-                    "priority": "medium",
-                    "tag": "occupancy_mismatch"
-                }
-            elif temperature > 26:
-                recommendation = {
-                    "description": "Adjust HVAC: Temperature exceeds 26°C, consider cooling optimization.",
-                    "priority": "low",
-                    "tag": "temperature_control"
-                }
-            else:
-                recommendation = {
-                    "description": "No immediate action required: Conditions within optimal range.",
-                    "priority": "low",
-                    "tag": "normal"
-                }
-
-            recommendations.append((
-                timestamp,
-                building_id,
-                predicted_energy if predicted_energy else 0.0,
-                json.dumps(recommendation)
-            ))
-
-        # Insert or update recommendations
-        if recommendations:
-            cur.executemany("""
-                INSERT INTO recommendations (timestamp, building_id, predicted_energy, recommendation)
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT (timestamp, building_id) DO UPDATE
-                  SET predicted_energy = EXCLUDED.predicted_energy,
-                      recommendation = EXCLUDED.recommendation
-            """, recommendations)
-
-        conn.commit()
         cur.close()
-        conn.close()
+        _schema_initialized = True
 
-        return len(recommendations)
+        return recommendation_count
 
     except Exception as e:
         raise Exception(f"Error generating recommendations: {str(e)}")
+
+    finally:
+        if not conn.closed:
+            conn.autocommit = False
+        pool.putconn(conn)
@@ -1,15 +1,60 @@
 import logging
 import azure.functions as func
 import os
-import json
+import orjson
+import numpy as np
+import csv
+import io
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
-from psycopg2 import extras
+import psycopg2.pool
 from urllib.parse import urlparse, unquote
 from datetime import datetime, timedelta
 
 logger = logging.getLogger("azure")
-logger.setLevel(logging.INFO)
+# Set TRIGGER_PREDICTION_LOG_LEVEL=DEBUG to log full request and response bodies.
+# An unknown name falls back to INFO rather than failing the import.
+LOG_LEVEL = os.getenv("TRIGGER_PREDICTION_LOG_LEVEL", "INFO").upper()
+if isinstance(logging.getLevelName(LOG_LEVEL), int):
+    logger.setLevel(LOG_LEVEL)
+else:
+    logger.setLevel(logging.INFO)
+    logger.warning("Unknown TRIGGER_PREDICTION_LOG_LEVEL %r; using INFO", LOG_LEVEL)
+
+# App settings only change with a worker restart, so they are read once
+ENDPOINT_URL = os.getenv("ENDPOINT_URL")
+API_KEY = os.getenv("API_KEY")
+DATABASE_URL = os.getenv("DATABASE_URL")
+CONFIG_OK = all([ENDPOINT_URL, API_KEY, DATABASE_URL])
+
+# Pooled Postgres connections reused across warm invocations
+_pg_pool = None
+_pg_pool_lock = threading.Lock()
+_schema_initialized = False
+
+# Keep-alive session so warm invocations reuse the TLS connection to the
+# inference endpoint. Scoring is side-effect free, so gateway errors are
+# retried for POST too. A read timeout is not: the endpoint may still be
+# scoring, and a replay would stack a second 300s wait onto the first.
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=2, read=0, backoff_factor=0.2, status_forcelist=[502, 503, 504], allowed_methods=["POST"], raise_on_status=False)
+))
+_session.headers.update({
+    "Content-Type": "application/json",
+    "Authorization": f"Bearer {API_KEY}"
+})
+
+# Synthesizing a test payload is a dev convenience; elsewhere a request
+# without usable input is rejected before it reaches the endpoint
+ALLOW_DEFAULT_DATA = os.getenv("ALLOW_DEFAULT_DATA") == "1"
 
 DEFAULT_VALUES = {
     "temperature": 25.0,
@@ -33,14 +78,30 @@ DYNAMIC_FEATURE_KEYS = [
     "power"
 ]
 
+# Per-feature defaults as a column, broadcast across timesteps
+DEFAULT_FEATURE_COLUMN = np.array([DEFAULT_VALUES[key] for key in DYNAMIC_FEATURE_KEYS], dtype=float)[:, None]
+
+# (feature, low, high, anomaly label), in precedence order: a timestep is
+# tagged with the first feature found outside its [low, high] range
+ANOMALY_RANGES = [
+    ("temperature", 10, 40, "temperature_out_of_range"),
+    ("power_factor", 0.4, 1.0, "power_factor_abnormal"),
+]
+ANOMALY_FEATURE_INDEX = np.array([DYNAMIC_FEATURE_KEYS.index(key) for key, _, _, _ in ANOMALY_RANGES])
+ANOMALY_LOW = np.array([low for _, low, _, _ in ANOMALY_RANGES], dtype=float)[:, None]
+ANOMALY_HIGH = np.array([high for _, _, high, _ in ANOMALY_RANGES], dtype=float)[:, None]
+
 def sanitize_iso_timestamp(ts: str) -> str:
-    if ts.endswith('+00:00Z'):
-        return ts.replace('+00:00Z', '+00:00')
-    elif ts.endswith('Z') and '+00:00' in ts:
-        return ts.replace('Z', '')
-    elif ts.endswith('Z'):
-        return ts.replace('Z', '+00:00')
-    return ts
+    # fromisoformat on 3.10 rejects a trailing 'Z'; drop it, or spell it
+    # out as +00:00 when no offset is present
+    if not ts.endswith('Z'):
+        return ts
+    return ts[:-1] if '+00:00' in ts else ts[:-1] + '+00:00'
+
+# Forecast windows overlap run to run, so the same timestamps recur
+@functools.lru_cache(maxsize=8192)
+def parse_iso_timestamp(ts: str) -> datetime:
+    return datetime.fromisoformat(sanitize_iso_timestamp(ts))
 
 def parse_database_url(db_url):
     parsed = urlparse(db_url)
@@ -53,6 +114,89 @@ def parse_database_url(db_url):
         "sslmode": "require"
     }
 
+def get_pg_pool(db_url):
+    global _pg_pool
+    if _pg_pool is None:
+        with _pg_pool_lock:
+            if _pg_pool is None:
+                # TCP keepalives stop idle pooled sockets being dropped between calls
+                _pg_pool = psycopg2.pool.ThreadedConnectionPool(
+                    1, 8, keepalives=1, keepalives_idle=60, **parse_database_url(db_url)
+                )
+    return _pg_pool
+
+def checkout_connection(db_url):
+    global _schema_initialized
+    # Runs while the inference call is in flight: a cold pool's TLS connect
+    # and, once per warm worker, the table DDL overlap with the endpoint
+    # latency. The DDL commits straight away; left open, its locks would be
+    # held for the whole inference call.
+    pool = get_pg_pool(db_url)
+    conn = pool.getconn()
+    if _schema_initialized:
+        return conn
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS predictions (
+                timestamp TIMESTAMP NOT NULL,
+                building_id INT NOT NULL,
+                predicted_energy DOUBLE PRECISION,
+                anomaly TEXT,
+                PRIMARY KEY (timestamp, building_id)
+            );
+            CREATE TABLE IF NOT EXISTS recommendations (
+                timestamp TIMESTAMP NOT NULL,
+                building_id INT NOT NULL,
+                predicted_energy DOUBLE PRECISION,
+                recommendation JSONB,
+                PRIMARY KEY (timestamp, building_id)
+            );
+            CREATE TABLE IF NOT EXISTS sensor_data (
+                timestamp TIMESTAMP NOT NULL,
+                building_id INT NOT NULL,
+                temperature DOUBLE PRECISION,
+                humidity DOUBLE PRECISION,
+                occupancy INT,
+                energy DOUBLE PRECISION,
+                current DOUBLE PRECISION,
+                voltage DOUBLE PRECISION,
+                power_factor DOUBLE PRECISION,
+                power DOUBLE PRECISION,
+                source TEXT NOT NULL DEFAULT 'firebase',
+                PRIMARY KEY (timestamp, building_id)
+            );
+            ALTER TABLE sensor_data ADD COLUMN IF NOT EXISTS source TEXT NOT NULL DEFAULT 'firebase';
+        """)
+        cur.close()
+        conn.commit()
+        _schema_initialized = True
+    except Exception:
+        pool.putconn(conn)
+        raise
+    return conn
+
+def copy_upsert(cur, batches):
+    # COPY each (table, rows, update_columns) batch into a transaction-scoped
+    # staging table, then merge with a single upsert per table so ON CONFLICT
+    # semantics are preserved. Every staging table is created in one
+    # round-trip and every merge runs in one more.
+    cur.execute("".join(
+        f"CREATE TEMP TABLE {table}_stage (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP;"
+        for table, _, _ in batches
+    ))
+    for table, rows, _ in batches:
+        buf = io.StringIO()
+        csv.writer(buf).writerows(rows)
+        buf.seek(0)
+        cur.copy_expert(f"COPY {table}_stage FROM STDIN WITH CSV", buf)
+    cur.execute("".join(f"""
+        INSERT INTO {table}
+        SELECT * FROM {table}_stage
+        ON CONFLICT (timestamp, building_id) DO UPDATE
+          SET {", ".join(f"{column} = EXCLUDED.{column}" for column in update_columns)};
+    """ for table, _, update_columns in batches))
+
 def build_dynamic_series(flattened_input, num_timesteps):
     dynamic_series = {}
     for key in DYNAMIC_FEATURE_KEYS:
@@ -62,14 +206,24 @@ def build_dynamic_series(flattened_input, num_timesteps):
         dynamic_series[key] = values
     return dynamic_series
 
+def build_inference_payload(dynamic_series, num_timesteps):
+    # Hourly series ending now; the target is a placeholder ramp
+    base_datetime = datetime.utcnow() - timedelta(hours=num_timesteps)
+    return {
+        "data": [{
+            "datetime": base_datetime.isoformat(timespec='seconds') + 'Z',
+            "target": 50 + np.arange(num_timesteps) * 0.5,
+            "feat_dynamic_real": [dynamic_series[key] for key in DYNAMIC_FEATURE_KEYS],
+            "feat_static_cat": [0],
+            "feat_static_real": [1000.0],
+            "item_id": "meter_001"
+        }]
+    }
+
 def main(req: func.HttpRequest) -> func.HttpResponse:
     logger.info("Function TriggerPrediction started")
 
-    endpoint_url = os.getenv("ENDPOINT_URL")
-    api_key = os.getenv("API_KEY")
-    db_url = os.getenv("DATABASE_URL")
-
-    if not all([endpoint_url, api_key, db_url]):
+    if not CONFIG_OK:
         return func.HttpResponse("Missing environment variables", status_code=500)
 
     try:
@@ -77,6 +231,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     except ValueError:
         req_body = None
 
+    conn = None
     try:
         if req_body and "data" in req_body:
             original_data = req_body
@@ -84,55 +239,40 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         elif req_body and any(k in req_body for k in DYNAMIC_FEATURE_KEYS):
             logger.info("Using flattened Firebase input format")
             num_timesteps = max(len(v) for k, v in req_body.items() if k in DYNAMIC_FEATURE_KEYS and isinstance(v, list))
-            base_datetime = datetime.utcnow() - timedelta(hours=num_timesteps)
-            dynamic_series = build_dynamic_series(req_body, num_timesteps)
-
-            original_data = {
-                "data": [{
-                    "datetime": base_datetime.isoformat(timespec='seconds') + 'Z',
-                    "target": [50 + i * 0.5 for i in range(num_timesteps)],
-                    "feat_dynamic_real": [dynamic_series[key] for key in DYNAMIC_FEATURE_KEYS],
-                    "feat_static_cat": [0],
-                    "feat_static_real": [1000.0],
-                    "item_id": "meter_001"
-                }]
-            }
+            original_data = build_inference_payload(build_dynamic_series(req_body, num_timesteps), num_timesteps)
+
+        elif not ALLOW_DEFAULT_DATA:
+            return func.HttpResponse("Missing data", status_code=400)
 
         else:
             logger.info("Generating default test data")
             num_timesteps = 5
-            base_datetime = datetime.utcnow() - timedelta(hours=num_timesteps)
-            dynamic_series = {
-                key: [DEFAULT_VALUES[key] for _ in range(num_timesteps)]
-                for key in DYNAMIC_FEATURE_KEYS
-            }
-
-            original_data = {
-                "data": [{
-                    "datetime": base_datetime.isoformat(timespec='seconds') + 'Z',
-                    "target": [50 + i * 0.5 for i in range(num_timesteps)],
-                    "feat_dynamic_real": [dynamic_series[key] for key in DYNAMIC_FEATURE_KEYS],
-                    "feat_static_cat": [0],
-                    "feat_static_real": [1000.0],
-                    "item_id": "meter_001"
-                }]
-            }
-
-        logger.info(f"Sending request to inference endpoint with data: {json.dumps(original_data, indent=2)}")
-
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
-
-        response = requests.post(endpoint_url, headers=headers, data=json.dumps(original_data))
-        logger.info(f"Response status: {response.status_code}")
-        logger.info(f"Response text (first 500 chars): {response.text[:500]}")
+            original_data = build_inference_payload(build_dynamic_series({}, num_timesteps), num_timesteps)
+
+        # Serialized once; the logged payload is the exact body sent.
+        # orjson writes NumPy arrays directly, without a .tolist() copy.
+        payload = orjson.dumps(original_data, option=orjson.OPT_SERIALIZE_NUMPY)
+        logger.info("Sending %d-byte request to inference endpoint", len(payload))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Inference request body: %s", payload.decode())
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            conn_future = executor.submit(checkout_connection, DATABASE_URL)
+            try:
+                response = _session.post(ENDPOINT_URL, data=payload, timeout=(5, 300))
+            finally:
+                conn = conn_future.result()
+
+        logger.info("Response status: %s", response.status_code)
+        # Slice the raw bytes first: response.text would decode (and, without a
+        # declared charset, sniff) the whole body just to log its head
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Response text (first 500 chars): %s", response.content[:500].decode('utf-8', 'replace'))
         response.raise_for_status()
 
-        predictions = json.loads(response.text)
+        predictions = orjson.loads(response.content)
         if isinstance(predictions, str):
-            predictions = json.loads(predictions)
+            predictions = orjson.loads(predictions)
 
         forecast = predictions.get("forecast", [])
         recommendations = predictions.get("recommendations", [])
@@ -142,128 +282,98 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         if not forecast:
             return func.HttpResponse("No forecast returned", status_code=500)
 
-        conn = psycopg2.connect(**parse_database_url(db_url))
         cur = conn.cursor()
 
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS predictions (
-                timestamp TIMESTAMP NOT NULL,
-                building_id INT NOT NULL,
-                predicted_energy DOUBLE PRECISION,
-                anomaly TEXT,
-                PRIMARY KEY (timestamp, building_id)
-            );
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS recommendations (
-                timestamp TIMESTAMP NOT NULL,
-                building_id INT NOT NULL,
-                predicted_energy DOUBLE PRECISION,
-                recommendation JSONB,
-                PRIMARY KEY (timestamp, building_id)
-            );
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS sensor_data (
-                timestamp TIMESTAMP NOT NULL,
-                building_id INT NOT NULL,
-                temperature DOUBLE PRECISION,
-                humidity DOUBLE PRECISION,
-                occupancy INT,
-                energy DOUBLE PRECISION,
-                current DOUBLE PRECISION,
-                voltage DOUBLE PRECISION,
-                power_factor DOUBLE PRECISION,
-                power DOUBLE PRECISION,
-                PRIMARY KEY (timestamp, building_id)
-            );
-        """)
-
         record = original_data["data"][0]
         building_id = record.get("feat_static_cat", [0])[0]
-        start = datetime.fromisoformat(sanitize_iso_timestamp(record["datetime"]))
+        start = parse_iso_timestamp(record["datetime"])
         dynamic_data = record["feat_dynamic_real"]
         target = record["target"]
-        timestamps = [start + timedelta(hours=i) for i in range(len(target))]
-
-        predictions_bulk = []
-        recommendations_bulk = []
-        sensor_data_bulk = []
-
-        for i, ts in enumerate(timestamps):
-            pred = forecast[0][i] if isinstance(forecast[0], list) else forecast[i]
-
-            try:
-                temp, hum, occ, energy, current, voltage, pf, power = [f[i] for f in dynamic_data]
-            except Exception:
-                logger.warning(f"Incomplete feature set at timestep {i}; filling with defaults")
-                features = [f[i] if i < len(f) else DEFAULT_VALUES[key]
-                            for f, key in zip(dynamic_data, DYNAMIC_FEATURE_KEYS)]
-                temp, hum, occ, energy, current, voltage, pf, power = features
-
-            anomaly = None
-            if not (10 <= temp <= 40):
-                anomaly = f"temperature_out_of_range:{temp}"
-            elif not (0.4 <= pf <= 1.0):
-                anomaly = f"power_factor_abnormal:{pf}"
-
-            predictions_bulk.append((ts, building_id, pred, anomaly))
-            sensor_data_bulk.append((ts, building_id, temp, hum, int(occ), energy, current, voltage, pf, power))
+        # Hourly steps built as one datetime64 range; the staged columns are
+        # TIMESTAMP without time zone, which drops any offset anyway
+        timestamps = (
+            np.datetime64(start.replace(tzinfo=None), "us") + np.arange(len(target), dtype="timedelta64[h]")
+        ).tolist()
+        building_ids = [building_id] * len(timestamps)
+
+        # The forecast shape is the same for every step, so resolve it once
+        predicted = forecast[0] if isinstance(forecast[0], list) else forecast
+        if len(predicted) < len(timestamps):
+            raise IndexError(f"Forecast has {len(predicted)} values for {len(timestamps)} timesteps")
+        predicted = predicted[:len(timestamps)]
+
+        # One (feature, timestep) array, pre-filled with defaults so short
+        # series are padded once instead of per timestep
+        features = np.tile(DEFAULT_FEATURE_COLUMN, len(timestamps))
+        for row, series in zip(features, dynamic_data):
+            filled = min(len(series), len(timestamps))
+            row[:filled] = series[:filled]
+            if filled < len(timestamps):
+                logger.warning("Incomplete feature series from timestep %d; filling with defaults", filled)
+
+        # Range checks run over whole feature rows; only flagged timesteps
+        # pay for formatting an anomaly string
+        checked = features[ANOMALY_FEATURE_INDEX]
+        out_of_range = ~((checked >= ANOMALY_LOW) & (checked <= ANOMALY_HIGH))
+        first_out_of_range = out_of_range.argmax(axis=0)
+        anomalies = [None] * len(timestamps)
+        for i in np.flatnonzero(out_of_range.any(axis=0)).tolist():
+            rule = first_out_of_range[i]
+            anomalies[i] = f"{ANOMALY_RANGES[rule][3]}:{checked[rule, i]}"
+
+        # Rows are zipped together from whole columns; occupancy is stored as INT
+        columns = features.tolist()
+        occupancy_index = DYNAMIC_FEATURE_KEYS.index("occupancy")
+        columns[occupancy_index] = features[occupancy_index].astype(int).tolist()
+        predictions_bulk = list(zip(timestamps, building_ids, predicted, anomalies))
+        # Tagged so FetchFirebaseData leaves these out of the next forecast input
+        sensor_data_bulk = list(zip(timestamps, building_ids, *columns, ["trigger_prediction"] * len(timestamps)))
 
         if postgres_ready:
             recommendations_bulk = [
                 (
-                    datetime.fromisoformat(sanitize_iso_timestamp(rec["timestamp"])),
+                    parse_iso_timestamp(rec["timestamp"]),
                     int(rec["building_id"]),
                     float(rec["predicted_energy"]),
-                    json.dumps(rec["recommendation"])
+                    orjson.dumps(rec["recommendation"]).decode()
                 )
                 for rec in postgres_ready
             ]
         else:
-            for i, ts in enumerate(timestamps):
-                pred = forecast[0][i] if isinstance(forecast[0], list) else forecast[i]
-                rec = recommendations[i] if i < len(recommendations) else {}
-                recommendations_bulk.append((ts, building_id, pred, json.dumps(rec)))
-
-        cur.executemany("""
-            INSERT INTO predictions (timestamp, building_id, predicted_energy, anomaly)
-            VALUES (%s, %s, %s, %s)
-            ON CONFLICT (timestamp, building_id) DO UPDATE
-              SET predicted_energy = EXCLUDED.predicted_energy,
-                  anomaly = EXCLUDED.anomaly
-        """, predictions_bulk)
-
-        cur.executemany("""
-            INSERT INTO recommendations (timestamp, building_id, predicted_energy, recommendation)
-            VALUES (%s, %s, %s, %s)
-            ON CONFLICT (timestamp, building_id) DO UPDATE
-              SET predicted_energy = EXCLUDED.predicted_energy,
-                  recommendation = EXCLUDED.recommendation
-        """, recommendations_bulk)
-
-        cur.executemany("""
-            INSERT INTO sensor_data (timestamp, building_id, temperature, humidity, occupancy, energy, current, voltage, power_factor, power)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (timestamp, building_id) DO UPDATE
-              SET temperature = EXCLUDED.temperature,
-                  humidity = EXCLUDED.humidity,
-                  occupancy = EXCLUDED.occupancy,
-                  energy = EXCLUDED.energy,
-                  current = EXCLUDED.current,
-                  voltage = EXCLUDED.voltage,
-                  power_factor = EXCLUDED.power_factor,
-                  power = EXCLUDED.power
-        """, sensor_data_bulk)
+            # Steps past the model's recommendations all share one "{}" string
+            recommendation_json = [orjson.dumps(rec).decode() for rec in recommendations[:len(timestamps)]]
+            recommendation_json += ["{}"] * (len(timestamps) - len(recommendation_json))
+            recommendations_bulk = list(zip(timestamps, building_ids, predicted, recommendation_json))
+
+        # All three writes share one transaction and one COMMIT. The rows are
+        # regenerated by the next run, so that COMMIT need not wait for the
+        # WAL flush; SET LOCAL ends with the transaction.
+        cur.execute("SET LOCAL synchronous_commit TO OFF")
+
+        # An upsert rejects a key repeated within one statement, so keep the
+        # last recommendation per (timestamp, building_id) as executemany did.
+        # Time-ordered rows keep inserts on the active hypertable chunk.
+        recommendations_bulk = sorted({row[:2]: row for row in recommendations_bulk}.values(), key=lambda row: row[:2])
+        copy_upsert(cur, [
+            ("predictions", predictions_bulk, ["predicted_energy", "anomaly"]),
+            ("recommendations", recommendations_bulk, ["predicted_energy", "recommendation"]),
+            ("sensor_data", sensor_data_bulk, [
+                "temperature", "humidity", "occupancy", "energy", "current", "voltage", "power_factor", "power", "source"
+            ]),
+        ])
 
         conn.commit()
         cur.close()
-        conn.close()
 
     except Exception as e:
         logger.error(f"Processing error: {e}", exc_info=True)
         return func.HttpResponse(f"Error: {str(e)}", status_code=500)
 
+    finally:
+        # The pool rolls back anything left open before reusing the connection
+        if conn is not None:
+            get_pg_pool(DATABASE_URL).putconn(conn)
+
     try:
         # Return clean recommendations only
         clean_recommendations = []
@@ -278,7 +388,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                     clean_recommendations.append({})
 
         return func.HttpResponse(
-            json.dumps({
+            orjson.dumps({
                 "status": "success",
                 "stored_predictions": len(predictions_bulk),
                 "stored_sensor_data": len(sensor_data_bulk),
@@ -1,10 +1,10 @@
 # invoke_http_function/__init__.py
 import azure.functions as func
-import requests
 import logging
-import json
+import orjson
+from shared_code.http_client import client
 
-def main(params: dict) -> str:
+async def main(params: dict) -> str:
     function_name = params.get("function_name", "UnknownFunction")
     url = params.get("url")
 
@@ -14,19 +14,20 @@ def main(params: dict) -> str:
 
     try:
         logging.info(f"Invoking {function_name} via POST {url}")
-        response = requests.post(url)
+        response = await client.post(url)
 
         logging.info(f"{function_name} response code: {response.status_code}")
         if response.status_code >= 400:
             logging.error(f"{function_name} error: {response.text}")
             return f"Failed: {function_name} - HTTP {response.status_code}"
 
+        # Parsed straight from the body bytes; no text decode unless it isn't JSON
         try:
-            content = response.json()
-        except Exception:
+            content = orjson.loads(response.content)
+        except orjson.JSONDecodeError:
             content = response.text
 
-        logging.info(f"{function_name} succeeded. Response content: {json.dumps(content) if isinstance(content, dict) else content}")
+        logging.info(f"{function_name} succeeded. Response content: {orjson.dumps(content).decode() if isinstance(content, dict) else content}")
         return f"Success: {function_name}"
 
     except Exception as e:
@@ -0,0 +1,15 @@
+# shared_code/http_client.py
+import httpx
+
+# One client per worker, shared by every activity that calls back into the
+# Functions host; HTTP/2 multiplexes their requests over a single keep-alive
+# connection. The targets write data, so only failed connects are retried.
+# Read timeout matches the 230 s cap Azure front ends put on HTTP triggers.
+client = httpx.AsyncClient(
+    transport=httpx.AsyncHTTPTransport(
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        http2=True,
+        retries=3,
+    ),
+    timeout=httpx.Timeout(230.0, connect=3.0),
+)
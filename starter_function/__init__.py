@@ -2,23 +2,100 @@
 import azure.functions as func
 import azure.durable_functions as df
 import logging
-from datetime import datetime
+import asyncio
+import time
+
+logger = logging.getLogger(__name__)
+
+ORCHESTRATOR_NAME = "orchestrator_function"
+# Fixed ID to ensure only one instance at a time
+INSTANCE_ID = "energy-orchestrator"
+
+# start_new returns once the start message is queued; if the host is slow
+# to acknowledge, the tick stops waiting and lets the request finish alone.
+# How soon the queued start is picked up is governed by host.json's
+# maxQueuePollingInterval: the idle control-queue backoff otherwise grows
+# to 30 s, so keep it short.
+START_TIMEOUT_SECONDS = 5
+
+# An orchestration seen started or running this recently is assumed to
+# still be running, so re-fired ticks (past-due catch-up, restarts) skip
+# the storage round-trip entirely
+RECENT_START_SECONDS = 30
+_last_start_seen = None
+_start_lock = asyncio.Lock()
+
+# The binding payload is identical from tick to tick on a worker, so the
+# client parsed from it is kept and only rebuilt if the payload changes
+_client = None
+_client_binding = None
+
+def log_late_start(task: asyncio.Future):
+    global _last_start_seen
+    if task.cancelled():
+        return
+    e = task.exception()
+    if e is None or "already exists" in str(e).lower():
+        # Started, or refused because the orchestration is still running
+        _last_start_seen = time.monotonic()
+        if e is not None:
+            logger.info("Instance '%s' was already running; the late start request was refused.", INSTANCE_ID)
+        return
+    logger.error("Orchestration start failed after the starter returned: %s", e)
+
+def get_client(starter: str) -> df.DurableOrchestrationClient:
+    global _client, _client_binding
+    if _client is None or _client_binding != starter:
+        _client = df.DurableOrchestrationClient(starter)
+        _client_binding = starter
+    return _client
 
 async def main(mytimer: func.TimerRequest, starter: str):
-    utc_timestamp = datetime.utcnow().isoformat()
-    logging.info(f"starter_function triggered at {utc_timestamp}")
+    global _last_start_seen
+    # The log record carries its own timestamp
+    logger.info("starter_function triggered")
+
+    now = time.monotonic()
+    if _last_start_seen is not None and now - _last_start_seen < RECENT_START_SECONDS:
+        logger.info("Orchestration started moments ago. Skipping trigger.")
+        return
+
+    # Overlapping fires on one worker (a tick outliving the interval, or
+    # catch-up runs) don't queue up behind each other
+    if _start_lock.locked():
+        logger.info("Previous tick is still starting the orchestration. Skipping trigger.")
+        return
 
-    try:
-        client = df.DurableOrchestrationClient(starter)
+    instance_id = INSTANCE_ID
 
-        instance_id = "energy-orchestrator"  # fixed ID to ensure only one instance at a time
+    async with _start_lock:
+        try:
+            client = get_client(starter)
 
-        status = await client.get_status(instance_id)
-        if status and status.runtime_status in ["Running", "Pending"]:
-            logging.info(f"Instance '{instance_id}' is already running. Skipping trigger.")
-            return
+            # start_new on the fixed ID is the singleton check itself: host.json
+            # only lets a finished instance be replaced, so a Running or Pending
+            # one is refused in the same storage round-trip
+            start = asyncio.ensure_future(client.start_new(ORCHESTRATOR_NAME, instance_id))
+            try:
+                instance_id = await asyncio.wait_for(asyncio.shield(start), timeout=START_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                start.add_done_callback(log_late_start)
+                logger.info("Start of '%s' requested; not waiting for the acknowledgement", instance_id)
+                return
+            except Exception as e:
+                if "already exists" not in str(e).lower():
+                    raise
+                _last_start_seen = now
+                logger.info("Instance '%s' is already running. Skipping trigger.", instance_id)
+                return
 
-        instance_id = await client.start_new("orchestrator_function", None)
-        logging.info(f"Started orchestration with ID = '{instance_id}'")
-    except Exception as e:
-        logging.error(f"Failed to start orchestration: {str(e)}", exc_info=True)
+            _last_start_seen = now
+            logger.info("Started orchestration with ID = '%s'", instance_id)
+        except Exception as e:
+            # A failed tick is retried by the next one; the traceback is only
+            # worth its formatting and ingestion cost when debugging
+            logger.error(
+                "Failed to start orchestration: %r", e,
+                exc_info=logger.isEnabledFor(logging.DEBUG),
+                extra={"instance_id": instance_id},
+            )